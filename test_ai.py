@@ -2,38 +2,220 @@ from pdfminer.converter import TextConverter
 from pdfminer.layout import LAParams
 from pdfminer.pdfpage import PDFPage
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
 from io import StringIO
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
 import sys
 import os
 import re
 import json
+import hashlib
+import importlib.util
+import mmap
+import random
+import shutil
+import socket
+import threading
+import time
+import uuid
 from datetime import datetime
 import google.generativeai as genai
 
-def convert_pdf_to_txt(path):
-    rsrcmgr = PDFResourceManager()
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Pages with fewer non-blank characters per square inch than this are treated
+# as scanned images and sent to OCR instead of relying on pdfminer's text.
+OCR_MIN_CHARS_PER_SQ_INCH = 1.0
+OCR_DPI = 300
+OCR_LANG = "fra+eng"
+OCR_CACHE_FOLDER = "ocr cache"
+# Each OCR process holds one rendered page plus Tesseract; batch workers run
+# OCR one page at a time so this is all they add to a document's footprint.
+OCR_WORKERS = int(os.environ.get("INVOICE_OCR_WORKERS", os.cpu_count() or 1))
+OCR_PAGE_MEMORY_MB = 150
+
+# Memory-bounded mode: the PDF is memory-mapped, pdfminer's per-document
+# object cache is disabled and extracted text past the spill threshold goes
+# to a temporary file instead of staying in memory.
+LOW_MEMORY = os.environ.get("INVOICE_LOW_MEMORY", "0") == "1"
+SPILL_THRESHOLD_MB = float(os.environ.get("INVOICE_SPILL_THRESHOLD_MB", "8"))
+
+# Batch scheduling: documents are only admitted while the estimated memory of
+# in-flight documents fits in INVOICE_WORKERS * INVOICE_WORKER_MEMORY_MB.
+# A budget of 0 disables admission control.
+BATCH_WORKERS = int(os.environ.get("INVOICE_WORKERS", os.cpu_count() or 1))
+WORKER_MEMORY_MB = float(os.environ.get("INVOICE_WORKER_MEMORY_MB", "0"))
+BASE_WORKER_MEMORY_MB = 80
+MEMORY_COST_FACTOR = 12
+LOW_MEMORY_COST_FACTOR = 3
+
+PROMPT_TEXT_LIMIT = 4000
+
+# Distributed mode: workers on any node that can see the queue directory
+# lease jobs by renaming them from pending/ to leased/. A lease that is not
+# renewed within INVOICE_LEASE_TIMEOUT seconds is returned to pending/, and a
+# job that fails INVOICE_MAX_ATTEMPTS times is moved to dead/.
+QUEUE_FOLDERS = ("pending", "leased", "done", "dead", "files", "results")
+LEASE_TIMEOUT = float(os.environ.get("INVOICE_LEASE_TIMEOUT", "600"))
+MAX_ATTEMPTS = int(os.environ.get("INVOICE_MAX_ATTEMPTS", "3"))
+POLL_INTERVAL = float(os.environ.get("INVOICE_POLL_INTERVAL", "5"))
+# Retries wait INVOICE_RETRY_BACKOFF seconds, doubling on every attempt.
+RETRY_BACKOFF = float(os.environ.get("INVOICE_RETRY_BACKOFF", "60"))
+RETRY_BACKOFF_MAX = 3600
+
+# Model routing: simple invoices start on the first (cheapest, fastest) tier
+# and only move up when the answer fails validation. Complex invoices start
+# one tier up. Per-model latency and success counts are kept in
+# INVOICE_MODEL_STATS and used to skip tiers that rarely pay off.
+MODEL_TIERS = [
+    "models/gemini-1.5-flash",
+    "models/gemini-1.5-pro"
+]
+COMPLEXITY_THRESHOLD = 0.25
+MODEL_STATS_FILE = os.environ.get("INVOICE_MODEL_STATS", "model_stats.json")
+MIN_ROUTING_SAMPLES = 10
+MIN_SUCCESS_RATE = 0.7
+ROUTING_EXPLORATION = 0.05
+STATS_LOCK_TIMEOUT = 5
+# Observations lose half their weight every INVOICE_STATS_HALF_LIFE seconds.
+STATS_HALF_LIFE = float(os.environ.get("INVOICE_STATS_HALF_LIFE", "1800"))
+AMOUNT_PATTERN = r"\d{1,3}(?:[ \u00a0.,]\d{3})*[.,]\d{2}\b"
+NOISE_PATTERN = r"\(cid:\d+\)|[\ufffd\ue000-\uf8ff\x00-\x08\x0b\x0e-\x1f]"
+FRENCH_WORDS = {"le", "la", "les", "des", "du", "facture", "montant", "date", "prix", "quantité"}
+ENGLISH_WORDS = {"the", "and", "of", "invoice", "amount", "date", "price", "quantity", "due"}
+
+def is_image_only_page(page, page_text):
+    x0, y0, x1, y1 = page.mediabox
+    area_sq_inch = abs(x1 - x0) * abs(y1 - y0) / (72 * 72)
+    if area_sq_inch <= 0:
+        return not page_text.strip()
+    chars = len(re.sub(r"\s", "", page_text))
+    return chars / area_sq_inch < OCR_MIN_CHARS_PER_SQ_INCH
+
+def ocr_page(task):
+    from pdf2image import convert_from_path
+    import pytesseract
+
+    path, pageno = task
+    image = convert_from_path(path, dpi=OCR_DPI, first_page=pageno + 1, last_page=pageno + 1)[0]
+
+    page_hash = hashlib.sha256(f"{image.mode}{image.size}".encode() + image.tobytes()).hexdigest()
+    cache_file = os.path.join(OCR_CACHE_FOLDER, f"{page_hash}.txt")
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    text = pytesseract.image_to_string(image, lang=OCR_LANG)
+
+    os.makedirs(OCR_CACHE_FOLDER, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_file, cache_file)
+    return text
+
+def ocr_pages(path, pagenos):
+    if not pagenos:
+        return {}
+
+    if importlib.util.find_spec("pytesseract") is None or importlib.util.find_spec("pdf2image") is None:
+        print(f"Warning: {len(pagenos)} page(s) look scanned but OCR is unavailable (install pytesseract and pdf2image).")
+        return {}
+
+    print(f"Running OCR on {len(pagenos)} scanned page(s)...")
+    results = {}
+    with ProcessPoolExecutor(max_workers=min(len(pagenos), OCR_WORKERS)) as executor:
+        futures = {executor.submit(ocr_page, (path, pageno)): pageno for pageno in pagenos}
+        for future, pageno in futures.items():
+            try:
+                results[pageno] = future.result()
+            except Exception as e:
+                print(f"OCR failed on page {pageno + 1}: {e}")
+    return results
+
+def iter_pdf_page_texts(fp, caching=True):
+    rsrcmgr = PDFResourceManager(caching=caching)
     retstr = StringIO()
     codec = 'utf-8'
     laparams = LAParams()
     device = TextConverter(rsrcmgr, retstr, codec=codec, laparams=laparams)
-    fp = open(path, 'rb')
     interpreter = PDFPageInterpreter(rsrcmgr, device)
     password = ""
     maxpages = 0
-    caching = True
     pagenos=set()
 
-    for page in PDFPage.get_pages(fp, pagenos, maxpages=maxpages, password=password,caching=caching, check_extractable=True):
-        interpreter.process_page(page)
+    try:
+        for pageno, page in enumerate(PDFPage.get_pages(fp, pagenos, maxpages=maxpages, password=password,caching=caching, check_extractable=True)):
+            interpreter.process_page(page)
+            page_text = retstr.getvalue()
+            retstr.seek(0)
+            retstr.truncate(0)
+            yield pageno, is_image_only_page(page, page_text), page_text
+    finally:
+        device.close()
+        retstr.close()
+
+def convert_pdf_to_txt(path, signals=None):
+    page_texts = []
+    scanned_pagenos = []
+    with open(path, 'rb') as fp:
+        for pageno, scanned, page_text in iter_pdf_page_texts(fp):
+            if scanned:
+                scanned_pagenos.append(pageno)
+            page_texts.append(page_text)
 
-    text = retstr.getvalue()
+    # Only the pages that failed the density check pay for OCR.
+    for pageno, ocr_text in ocr_pages(path, scanned_pagenos).items():
+        page_texts[pageno] = ocr_text + "\f"
 
-    fp.close()
-    device.close()
-    retstr.close()
+    if signals is not None:
+        for page_text in page_texts:
+            update_text_signals(signals, page_text)
+
+    text = "".join(page_texts)
     return text
 
-def get_available_gemini_model():
+def new_spool_file():
+    return SpooledTemporaryFile(max_size=int(SPILL_THRESHOLD_MB * 1024 * 1024), mode='w+', encoding='utf-8', newline='')
+
+def convert_pdf_to_spooled_txt(path, signals=None):
+    text_file = new_spool_file()
+    page_lengths = []
+    scanned_pagenos = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as fp:
+        for pageno, scanned, page_text in iter_pdf_page_texts(fp, caching=False):
+            if scanned:
+                scanned_pagenos.append(pageno)
+            elif signals is not None:
+                update_text_signals(signals, page_text)
+            text_file.write(page_text)
+            page_lengths.append(len(page_text))
+
+    ocr_results = ocr_pages(path, scanned_pagenos)
+    if signals is not None:
+        for pageno in scanned_pagenos:
+            update_text_signals(signals, ocr_results.get(pageno, ""))
+    if ocr_results:
+        # Rewrite the spool one page at a time so OCR text lands in page order.
+        text_file.seek(0)
+        merged_file = new_spool_file()
+        for pageno, length in enumerate(page_lengths):
+            page_text = text_file.read(length)
+            merged_file.write(ocr_results[pageno] + "\f" if pageno in ocr_results else page_text)
+        text_file.close()
+        text_file = merged_file
+
+    text_file.seek(0)
+    return text_file
+
+def get_available_gemini_models():
     print("Checking available Gemini models...")
     
     preferred_models = [
@@ -51,50 +233,36 @@ def get_available_gemini_model():
         
         print(f"Found {len(available_models)} suitable models")
         
-        for preferred in preferred_models:
-            if preferred in available_models:
-                print(f"Selected preferred model: {preferred}")
-                return preferred
+        ordered_models = [preferred for preferred in preferred_models if preferred in available_models]
+        ordered_models += [name for name in available_models if name not in ordered_models]
         
-        if available_models:
-            selected = available_models[0]
-            print(f"Using first available model: {selected}")
-            return selected
-            
-        print("No suitable Gemini model supporting 'generateContent' found.")
-        return None
+        if not ordered_models:
+            print("No suitable Gemini model supporting 'generateContent' found.")
+        return ordered_models
         
     except Exception as e:
         print(f"Error listing Gemini models: {e}")
-        return None
+        return []
 
-def ai_extract_invoice_data(text):
+def empty_invoice_data(error, retryable=True):
+    return {
+        "invoice_number": None,
+        "billing_date": None,
+        "due_date": None,
+        "total_ttc": None,
+        "total_ht": None,
+        "tva_amount": None,
+        "company_info": {"name": None, "address": None, "phone": None, "email": None, "ICE": None},
+        "client_info": {"name": None, "address": None},
+        "bank_info": {"bank_name": None, "iban": None, "rib": None},
+        "articles": [],
+        "error": error,
+        "retryable": retryable
+    }
+
+def extract_with_model(text, model_name):
     
     try:
-        api_key = os.environ.get("GOOGLE_API_KEY") 
-        if not api_key:
-            # Replace 'your_api_key_here' with your actual API key for testing
-            api_key = "your_api_key_here"
-            print("Warning: Using hardcoded API key. Consider setting GOOGLE_API_KEY environment variable for production.")
-
-        genai.configure(api_key=api_key) 
-
-        model_name = get_available_gemini_model()
-        if not model_name:
-            return {
-                "invoice_number": None,
-                "billing_date": None,
-                "due_date": None,
-                "total_ttc": None,
-                "total_ht": None,
-                "tva_amount": None,
-                "company_info": {"name": None, "address": None, "phone": None, "email": None, "ice": None},
-                "client_info": {"name": None, "address": None},
-                "bank_info": {"bank_name": None, "iban": None, "rib": None},
-                "articles": [],
-                "error": "No suitable Gemini model found to perform extraction."
-            }
-        
         model = genai.GenerativeModel(model_name)
 
         prompt = f"""
@@ -147,7 +315,7 @@ def ai_extract_invoice_data(text):
         }}
 
         Invoice Text:
-        {text[:4000]}
+        {text[:PROMPT_TEXT_LIMIT]}
         """
 
         response = model.generate_content(prompt)
@@ -180,61 +348,315 @@ def ai_extract_invoice_data(text):
                 except:
                     continue
             
-            return {
-                "invoice_number": None,
-                "billing_date": None,
-                "due_date": None,
-                "total_ttc": None,
-                "total_ht": None,
-                "tva_amount": None,
-                "company_info": {"name": None, "address": None, "phone": None, "email": None, "ICE": None},
-                "client_info": {"name": None, "address": None},
-                "bank_info": {"bank_name": None, "iban": None, "rib": None},
-                "articles": [],
-                "error": f"Failed to parse AI response. Raw response: {result[:200]}..."
-            }
+            return empty_invoice_data(f"Failed to parse AI response. Raw response: {result[:200]}...", retryable=False)
             
     except Exception as e:
-        return {
-            "invoice_number": None,
-            "billing_date": None,
-            "due_date": None,
-            "total_ttc": None,
-            "total_ht": None,
-            "tva_amount": None,
-            "company_info": {"name": None, "address": None, "phone": None, "email": None, "ICE": None},
-            "client_info": {"name": None, "address": None},
-            "bank_info": {"bank_name": None, "iban": None, "rib": None},
-            "articles": [],
-            "error": f"AI extraction failed: {str(e)}"
-        }
+        return empty_invoice_data(f"AI extraction failed: {str(e)}")
+
+def ai_extract_invoice_data(text, signals=None):
+    
+    if not text.strip():
+        return empty_invoice_data("No text could be extracted from the PDF, skipping Gemini call.", retryable=False)
+
+    try:
+        api_key = os.environ.get("GOOGLE_API_KEY") 
+        if not api_key:
+            # Replace 'your_api_key_here' with your actual API key for testing
+            api_key = "your_api_key_here"
+            print("Warning: Using hardcoded API key. Consider setting GOOGLE_API_KEY environment variable for production.")
+
+        genai.configure(api_key=api_key) 
+
+        available_models = get_available_gemini_models()
+        if not available_models:
+            return empty_invoice_data("No suitable Gemini model found to perform extraction.")
+
+        # Callers that stream the document pass signals gathered from every page;
+        # otherwise they are derived from the text we were given.
+        if signals is None:
+            signals = text_signals(text)
+        complexity, score, models = route_invoice(signals, available_models)
+        print(f"Routing {complexity} invoice (score {score:.2f}) to {models[0]}")
+
+        for i, model_name in enumerate(models):
+            start = time.perf_counter()
+            data = extract_with_model(text, model_name)
+            latency = time.perf_counter() - start
+
+            # Quota and network errors mean the model never answered: a
+            # stronger tier would hit the same wall and the model is not to
+            # blame, so hand the error back for a later retry.
+            if data.get("error") and data.get("retryable", True):
+                return data
+
+            problems = validate_invoice_data(data)
+            record_model_result(model_name, complexity, not problems, latency)
+            if not problems or i == len(models) - 1:
+                return data
+            print(f"⚠️ Validation failed with {model_name}: {'; '.join(problems)}. Escalating to {models[i + 1]}...")
+
+    except Exception as e:
+        return empty_invoice_data(f"AI extraction failed: {str(e)}")
+
+def parse_amount(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    amount = re.sub(r"[^\d,.\-]", "", str(value))
+    if "," in amount and "." in amount:
+        # Whichever separator comes last is the decimal one.
+        if amount.rfind(",") > amount.rfind("."):
+            amount = amount.replace(".", "").replace(",", ".")
+        else:
+            amount = amount.replace(",", "")
+    elif "," in amount:
+        if re.fullmatch(r"-?\d{1,3}(,\d{3})+", amount):
+            amount = amount.replace(",", "")
+        else:
+            amount = amount.replace(",", ".")
+    elif amount.count(".") > 1:
+        amount = amount.replace(".", "")
+
+    try:
+        return float(amount)
+    except ValueError:
+        return None
+
+def validate_invoice_data(data):
+    if data.get("error"):
+        return [data["error"]]
+
+    problems = []
+    if not data.get("invoice_number") and not data.get("total_ttc"):
+        problems.append("no invoice number or total TTC found")
+
+    total_ttc = parse_amount(data.get("total_ttc"))
+    total_ht = parse_amount(data.get("total_ht"))
+    tva_amount = parse_amount(data.get("tva_amount"))
+    if None not in (total_ttc, total_ht, tva_amount) and abs(total_ht + tva_amount - total_ttc) > max(0.05, abs(total_ttc) * 0.01):
+        problems.append(f"total HT + TVA ({total_ht + tva_amount:.2f}) does not match total TTC ({total_ttc:.2f})")
+    return problems
+
+def new_text_signals():
+    return {
+        "pages": 0,
+        "item_lines": 0,
+        "letters": 0,
+        "non_latin_letters": 0,
+        "french_words": set(),
+        "english_words": set(),
+        "tokens": 0,
+        "noise": 0
+    }
+
+def update_text_signals(signals, page_text):
+    signals["pages"] += 1
+    signals["item_lines"] += sum(1 for line in page_text.splitlines() if len(re.findall(AMOUNT_PATTERN, line)) >= 2)
+
+    letters = [c for c in page_text if c.isalpha()]
+    signals["letters"] += len(letters)
+    signals["non_latin_letters"] += sum(1 for c in letters if ord(c) > 0x24F)
+    words = set(re.findall(r"[a-zéèàûç]+", page_text.lower()))
+    signals["french_words"] |= words & FRENCH_WORDS
+    signals["english_words"] |= words & ENGLISH_WORDS
+
+    # Unmapped glyphs from pdfminer show up as (cid:NN), replacement
+    # characters, private-use code points or stray control characters.
+    # Lone currency signs and punctuation are normal on invoices.
+    tokens = page_text.split()
+    signals["tokens"] += len(tokens)
+    signals["noise"] += len(re.findall(NOISE_PATTERN, page_text))
+
+def text_signals(text):
+    signals = new_text_signals()
+    pages = text.split("\f")
+    if len(pages) > 1 and not pages[-1].strip():
+        pages.pop()
+    for page_text in pages:
+        update_text_signals(signals, page_text)
+    return signals
+
+def score_invoice_complexity(signals):
+    non_latin_ratio = signals["non_latin_letters"] / max(signals["letters"], 1)
+    if non_latin_ratio > 0.2:
+        language_score = 1.0
+    elif len(signals["french_words"]) >= 3 or len(signals["english_words"]) >= 3:
+        language_score = 0.0
+    else:
+        language_score = 0.5
+
+    quality_score = min(signals["noise"] / max(signals["tokens"], 1) * 10, 1.0)
+
+    return (0.2 * min((max(signals["pages"], 1) - 1) / 4, 1.0)
+            + 0.3 * min(signals["item_lines"] / 30, 1.0)
+            + 0.25 * language_score
+            + 0.25 * quality_score)
+
+# Stats only steer routing, so any failure to read or write them is logged
+# and ignored rather than costing an extraction that was already paid for.
+def load_model_stats():
+    try:
+        with open(MODEL_STATS_FILE, 'r', encoding='utf-8') as f:
+            return clean_model_stats(json.load(f))
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read model stats from {MODEL_STATS_FILE}: {e}")
+        return {}
+
+def clean_model_stats(stats):
+    # Drop anything that is not {model: {complexity: {counters}}} so a damaged
+    # or hand-edited file cannot break routing.
+    cleaned = {}
+    if not isinstance(stats, dict):
+        return cleaned
+    for model_name, entries in stats.items():
+        if not isinstance(entries, dict):
+            continue
+        for complexity, entry in entries.items():
+            if not isinstance(entry, dict):
+                continue
+            if not all(isinstance(entry.get(key), (int, float)) for key in ("calls", "successes", "total_latency")):
+                continue
+            if not isinstance(entry.get("updated_at"), (int, float)):
+                entry.pop("updated_at", None)
+            cleaned.setdefault(model_name, {})[complexity] = entry
+    return cleaned
+
+def lock_model_stats():
+    # Batch and queue workers may share one stats file; an OS-level lock keeps
+    # their read-modify-write cycles apart and is released by the kernel if a
+    # worker dies while holding it.
+    lock_fd = os.open(os.path.abspath(MODEL_STATS_FILE) + ".lock", os.O_CREAT | os.O_RDWR)
+    deadline = time.time() + STATS_LOCK_TIMEOUT
+    while True:
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(lock_fd, msvcrt.LK_NBLCK, 1)
+            return lock_fd
+        except OSError:
+            if time.time() > deadline:
+                os.close(lock_fd)
+                return None
+            time.sleep(0.05)
+
+def unlock_model_stats(lock_fd):
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        else:
+            msvcrt.locking(lock_fd, msvcrt.LK_UNLCK, 1)
+    finally:
+        os.close(lock_fd)
+
+def record_model_result(model_name, complexity, success, latency):
+    try:
+        lock_fd = lock_model_stats()
+        if lock_fd is None:
+            print(f"Warning: model stats are locked by another worker, skipping update for {model_name}.")
+            return
+        try:
+            stats = load_model_stats()
+            now = time.time()
+            entry = decay_stats_entry(stats.setdefault(model_name, {}).get(complexity), now)
+            stats[model_name][complexity] = entry
+            entry["calls"] += 1
+            entry["successes"] += 1 if success else 0
+            entry["total_latency"] += latency
+            write_json_atomic(os.path.abspath(MODEL_STATS_FILE), stats)
+        finally:
+            unlock_model_stats(lock_fd)
+    except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+        print(f"Warning: could not update model stats in {MODEL_STATS_FILE}: {e}")
+
+def decay_stats_entry(entry, now):
+    # Old observations fade out, so a model that had a bad spell is tried
+    # again once it is no longer backed by enough recent calls.
+    if not entry:
+        return {"calls": 0, "successes": 0, "total_latency": 0.0, "updated_at": now}
+    weight = 0.5 ** (max(now - entry.get("updated_at", now), 0) / STATS_HALF_LIFE)
+    return {
+        "calls": entry["calls"] * weight,
+        "successes": entry["successes"] * weight,
+        "total_latency": entry["total_latency"] * weight,
+        "updated_at": now
+    }
+
+def should_skip_model(model_name, next_model, stats, complexity):
+    now = time.time()
+    entry = decay_stats_entry(stats.get(model_name, {}).get(complexity), now)
+    if entry["calls"] < MIN_ROUTING_SAMPLES:
+        return False
+    # Keep sampling skipped tiers now and then so their stats can recover.
+    if random.random() < ROUTING_EXPLORATION:
+        return False
+
+    success_rate = entry["successes"] / entry["calls"]
+    if success_rate < MIN_SUCCESS_RATE:
+        return True
+
+    next_entry = decay_stats_entry(stats.get(next_model, {}).get(complexity), now)
+    if next_entry["calls"] < MIN_ROUTING_SAMPLES:
+        return False
+    # Trying this tier first costs its latency plus, on failure, the next one.
+    latency = entry["total_latency"] / entry["calls"]
+    next_latency = next_entry["total_latency"] / next_entry["calls"]
+    return latency + (1 - success_rate) * next_latency > next_latency
+
+def route_invoice(signals, available_models):
+    models = [name for name in MODEL_TIERS if name in available_models] or available_models[:1]
+    score = score_invoice_complexity(signals)
+    complexity = "complex" if score >= COMPLEXITY_THRESHOLD else "simple"
+
+    first = min(1, len(models) - 1) if complexity == "complex" else 0
+    stats = load_model_stats()
+    while first < len(models) - 1 and should_skip_model(models[first], models[first + 1], stats, complexity):
+        first += 1
+    return complexity, score, models[first:]
 
 def format_extraction_date():
     return datetime(2025, 7, 10).strftime("%d/%m/%Y")
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python test_ai.py <pdf_filename>")
-        print("Example: python test_ai.py modele_de_facture.pdf")
-        print("For files with spaces: python test_ai.py \"file with spaces.pdf\"")
-        sys.exit(1)
-    
-    pdf_path = sys.argv[1]
-    
-    if not os.path.exists(pdf_path):
-        print(f"❌ Error: File '{pdf_path}' not found!")
-        print("Make sure the file exists in the current directory.")
-        print("For files with spaces in the name, use quotes around the filename.")
-        sys.exit(1)
-    
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def estimate_pdf_memory_mb(pdf_path, low_memory):
+    size_mb = os.path.getsize(pdf_path) / (1024 * 1024)
+    if low_memory:
+        return BASE_WORKER_MEMORY_MB + OCR_PAGE_MEMORY_MB + SPILL_THRESHOLD_MB + size_mb * LOW_MEMORY_COST_FACTOR
+    return BASE_WORKER_MEMORY_MB + OCR_PAGE_MEMORY_MB + size_mb * MEMORY_COST_FACTOR
+
+def init_batch_worker():
+    global OCR_WORKERS
+    OCR_WORKERS = 1
+
+def process_invoice(pdf_path, low_memory=False):
     try:
         print("Starting PDF to text conversion...")
         print(f"Processing file: {pdf_path}")
         
-        extracted_text = convert_pdf_to_txt(pdf_path)
+        # In memory-bounded mode only the prompt-sized head of the text is kept in
+        # memory; the rest stays in the spool file until it is saved.
+        signals = new_text_signals()
+        if low_memory:
+            text_file = convert_pdf_to_spooled_txt(pdf_path, signals)
+            extracted_text = text_file.read(PROMPT_TEXT_LIMIT)
+        else:
+            text_file = None
+            extracted_text = convert_pdf_to_txt(pdf_path, signals)
         
         print("\n🤖 Using Gemini AI to analyze invoice...")
-        ai_results = ai_extract_invoice_data(extracted_text)
+        ai_results = ai_extract_invoice_data(extracted_text, signals)
         
         print("\n" + "="*60)
         print("🤖 GEMINI AI-POWERED INVOICE ANALYSIS")
@@ -302,6 +724,12 @@ if __name__ == "__main__":
         
         with open(output_file, 'w', encoding='utf-8') as f:
             f.write(extracted_text)
+            total_chars = len(extracted_text)
+            if text_file is not None:
+                for chunk in iter(lambda: text_file.read(1024 * 1024), ""):
+                    f.write(chunk)
+                    total_chars += len(chunk)
+                text_file.close()
         
         invoice_file = os.path.join(analysis_folder, f"{pdf_name}_gemini_analysis.txt")
         with open(invoice_file, 'w', encoding='utf-8') as f:
@@ -356,8 +784,270 @@ if __name__ == "__main__":
         
         print(f"\n✅ Success! Full text saved to: {output_file}")
         print(f"🤖 Gemini AI analysis saved to: {invoice_file}")
-        print(f"Total characters extracted: {len(extracted_text)}")
+        print(f"Total characters extracted: {total_chars}")
+
+        return ai_results
         
     except Exception as e:
         print(f"❌ Error occurred: {str(e)}")
-        print("Make sure the PDF file exists and is readable.")
\ No newline at end of file
+        print("Make sure the PDF file exists and is readable.")
+        return empty_invoice_data(str(e), retryable=isinstance(e, OSError))
+
+def process_batch(pdf_paths, workers=BATCH_WORKERS, worker_memory_mb=WORKER_MEMORY_MB, low_memory=LOW_MEMORY):
+    print(f"Processing {len(pdf_paths)} invoices with {workers} workers" + (f" and {worker_memory_mb:.0f} MB per worker" if worker_memory_mb else ""))
+
+    budget_mb = workers * worker_memory_mb
+    pending = deque(pdf_paths)
+    in_flight = {}
+    results = {}
+    # Documents that were in flight when a worker died are retried one at a
+    # time, so the one that kills its worker again is the only one marked failed.
+    isolated = set()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker)
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers:
+                pdf_path = pending[0]
+                doc_low_memory = low_memory
+                cost_mb = estimate_pdf_memory_mb(pdf_path, doc_low_memory)
+                # Documents too big for one worker's budget are switched to the
+                # memory-bounded path when that lowers their estimate, and run
+                # alone if they still do not fit.
+                if worker_memory_mb and cost_mb > worker_memory_mb and not doc_low_memory:
+                    low_memory_cost_mb = estimate_pdf_memory_mb(pdf_path, True)
+                    if low_memory_cost_mb < cost_mb:
+                        doc_low_memory = True
+                        cost_mb = low_memory_cost_mb
+                alone = pdf_path in isolated or bool(worker_memory_mb and cost_mb > worker_memory_mb)
+                in_flight_mb = sum(cost for _, cost, _ in in_flight.values())
+                if in_flight and (alone
+                                  or any(running_alone for _, _, running_alone in in_flight.values())
+                                  or (worker_memory_mb and in_flight_mb + cost_mb > budget_mb)):
+                    break
+
+                pending.popleft()
+                future = executor.submit(process_invoice, pdf_path, doc_low_memory)
+                in_flight[future] = (pdf_path, cost_mb, alone)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = any(isinstance(future.exception(), BrokenProcessPool) for future in done)
+            if broken:
+                # Every document still in the dead pool fails along with it.
+                done, _ = wait(in_flight)
+
+            for future in done:
+                pdf_path, _, _ = in_flight.pop(future)
+                try:
+                    results[pdf_path] = future.result()
+                except BrokenProcessPool:
+                    if pdf_path in isolated:
+                        results[pdf_path] = empty_invoice_data("Worker process died while processing this invoice (killed, possibly out of memory).")
+                    else:
+                        isolated.add(pdf_path)
+                        pending.appendleft(pdf_path)
+                except Exception as e:
+                    results[pdf_path] = empty_invoice_data(f"Batch worker failed: {e}")
+
+            if broken:
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker)
+    finally:
+        executor.shutdown()
+
+    failed = [pdf_path for pdf_path, ai_results in results.items() if ai_results.get("error")]
+    print(f"\n📦 Batch finished: {len(results) - len(failed)} succeeded, {len(failed)} failed")
+    for pdf_path in failed:
+        print(f"  ❌ {pdf_path}: {results[pdf_path]['error']}")
+    return results
+
+def write_json_atomic(path, data):
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+def init_queue(queue_dir):
+    for folder in QUEUE_FOLDERS:
+        os.makedirs(os.path.join(queue_dir, folder), exist_ok=True)
+
+def list_queue(queue_dir, folder, pattern="*.json"):
+    return sorted(str(p) for p in Path(queue_dir, folder).glob(pattern))
+
+def enqueue_invoices(queue_dir, pdf_paths):
+    init_queue(queue_dir)
+    for pdf_path in pdf_paths:
+        # Job ids start with the enqueue time so pending/ sorts in FIFO order.
+        job_id = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        pdf_name = os.path.basename(pdf_path)
+        job_folder = os.path.join(queue_dir, "files", job_id)
+        os.makedirs(job_folder)
+        shutil.copyfile(pdf_path, os.path.join(job_folder, pdf_name))
+
+        job = {"job_id": job_id, "pdf_name": pdf_name, "attempts": 0, "enqueued_at": time.time(), "last_error": None}
+        write_json_atomic(os.path.join(queue_dir, "pending", f"{job_id}.json"), job)
+        print(f"📥 Queued {pdf_path} as job {job_id}")
+
+def claim_job_file(path):
+    # Renaming is the lock: whoever renames the file owns the job.
+    job_path = re.sub(r"\.[0-9a-f]{32}\.claimed$", "", path)
+    claimed_path = f"{job_path}.{uuid.uuid4().hex}.claimed"
+    try:
+        os.rename(path, claimed_path)
+        # The claim's age starts now, so the reaper only takes over claims
+        # whose owner died before finishing with them.
+        os.utime(claimed_path)
+    except FileNotFoundError:
+        return None
+    return claimed_path
+
+def release_job(queue_dir, claimed_path, job, error, retryable=True):
+    job["attempts"] += 1
+    job["last_error"] = error
+    if not retryable or job["attempts"] >= MAX_ATTEMPTS:
+        write_json_atomic(os.path.join(queue_dir, "dead", f"{job['job_id']}.json"), job)
+        print(f"💀 Job {job['job_id']} moved to dead letters after {job['attempts']} attempt(s): {error}")
+    else:
+        # Back off so transient errors such as an exhausted Gemini quota have
+        # time to clear instead of burning every attempt back to back.
+        delay = min(RETRY_BACKOFF * 2 ** (job["attempts"] - 1), RETRY_BACKOFF_MAX)
+        job["not_before"] = time.time() + delay
+        write_json_atomic(os.path.join(queue_dir, "pending", f"{job['job_id']}.json"), job)
+        print(f"🔁 Job {job['job_id']} requeued, next attempt in {delay:.0f}s: {error}")
+    os.remove(claimed_path)
+
+def reap_expired_leases(queue_dir):
+    now = time.time()
+    for leased_path in list_queue(queue_dir, "leased") + list_queue(queue_dir, "leased", "*.claimed"):
+        try:
+            if now - os.path.getmtime(leased_path) < LEASE_TIMEOUT:
+                continue
+        except FileNotFoundError:
+            continue
+        claimed_path = claim_job_file(leased_path)
+        if claimed_path is None:
+            continue
+        with open(claimed_path, 'r', encoding='utf-8') as f:
+            job = json.load(f)
+        if os.path.exists(os.path.join(queue_dir, "results", f"{job['job_id']}.json")):
+            # The worker died after saving its result; only the bookkeeping is left.
+            os.rename(claimed_path, os.path.join(queue_dir, "done", f"{job['job_id']}.json"))
+            shutil.rmtree(os.path.join(queue_dir, "files", job["job_id"]), ignore_errors=True)
+            continue
+        release_job(queue_dir, claimed_path, job, "Lease expired before the job completed.")
+
+def lease_job(queue_dir, worker_id):
+    now = time.time()
+    for pending_path in list_queue(queue_dir, "pending"):
+        try:
+            with open(pending_path, 'r', encoding='utf-8') as f:
+                if json.load(f).get("not_before", 0) > now:
+                    continue
+        except FileNotFoundError:
+            continue
+        # Every lease gets its own file name, so a worker whose lease expired
+        # can never renew, complete or release a later lease on the same job.
+        job_id = Path(pending_path).stem
+        leased_path = os.path.join(queue_dir, "leased", f"{job_id}.{worker_id}.{uuid.uuid4().hex}.json")
+        try:
+            # Touch first so the lease starts fresh: rename keeps the mtime.
+            os.utime(pending_path)
+            os.rename(pending_path, leased_path)
+        except FileNotFoundError:
+            continue
+        with open(leased_path, 'r', encoding='utf-8') as f:
+            return json.load(f), leased_path
+    return None, None
+
+def renew_lease(leased_path, stop_event):
+    while not stop_event.wait(LEASE_TIMEOUT / 3):
+        try:
+            os.utime(leased_path)
+        except FileNotFoundError:
+            return
+
+def run_worker(queue_dir):
+    init_queue(queue_dir)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    print(f"👷 Worker {worker_id} polling queue: {queue_dir}")
+
+    processed = 0
+    while True:
+        reap_expired_leases(queue_dir)
+        job, leased_path = lease_job(queue_dir, worker_id)
+        if job is None:
+            if not list_queue(queue_dir, "leased", "*") and not list_queue(queue_dir, "pending"):
+                print(f"Queue is empty, worker {worker_id} stopping after {processed} job(s).")
+                return processed
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        print(f"\n📋 Job {job['job_id']} ({job['pdf_name']}), attempt {job['attempts'] + 1}/{MAX_ATTEMPTS}")
+        job_folder = os.path.join(queue_dir, "files", job["job_id"])
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=renew_lease, args=(leased_path, stop_event), daemon=True)
+        heartbeat.start()
+        try:
+            ai_results = process_invoice(os.path.join(job_folder, job["pdf_name"]), low_memory=LOW_MEMORY)
+        finally:
+            stop_event.set()
+            heartbeat.join()
+        processed += 1
+
+        claimed_path = claim_job_file(leased_path)
+        if claimed_path is None:
+            print(f"⚠️ Lease on job {job['job_id']} was lost before completion; the result is discarded and another worker will redo it.")
+            continue
+
+        if ai_results.get("error"):
+            release_job(queue_dir, claimed_path, job, ai_results["error"], ai_results.get("retryable", True))
+            continue
+
+        write_json_atomic(os.path.join(queue_dir, "results", f"{job['job_id']}.json"), {
+            "job_id": job["job_id"],
+            "source_file": job["pdf_name"],
+            "worker": worker_id,
+            "attempts": job["attempts"] + 1,
+            "completed_at": time.time(),
+            "ai_results": ai_results
+        })
+        os.rename(claimed_path, os.path.join(queue_dir, "done", f"{job['job_id']}.json"))
+        shutil.rmtree(job_folder, ignore_errors=True)
+
+if __name__ == "__main__":
+    if (len(sys.argv) < 2
+            or (sys.argv[1] == "--worker" and len(sys.argv) != 3)
+            or (sys.argv[1] == "--enqueue" and len(sys.argv) < 4)):
+        print("Usage: python test_ai.py <pdf_filename> [<pdf_filename> ...]")
+        print("Example: python test_ai.py modele_de_facture.pdf")
+        print("For files with spaces: python test_ai.py \"file with spaces.pdf\"")
+        print("Several files are processed as a batch (see INVOICE_WORKERS, INVOICE_WORKER_MEMORY_MB).")
+        print("Distributed mode: python test_ai.py --enqueue <queue_dir> <pdf_filename> [<pdf_filename> ...]")
+        print("                  python test_ai.py --worker <queue_dir>")
+        sys.exit(1)
+    
+    if sys.argv[1] == "--worker":
+        run_worker(sys.argv[2])
+        sys.exit(0)
+    
+    enqueue = sys.argv[1] == "--enqueue"
+    pdf_paths = sys.argv[3:] if enqueue else sys.argv[1:]
+    
+    for pdf_path in pdf_paths:
+        if not os.path.exists(pdf_path):
+            print(f"❌ Error: File '{pdf_path}' not found!")
+            print("Make sure the file exists in the current directory.")
+            print("For files with spaces in the name, use quotes around the filename.")
+            sys.exit(1)
+    
+    if enqueue:
+        enqueue_invoices(sys.argv[2], pdf_paths)
+    elif len(pdf_paths) == 1:
+        process_invoice(pdf_paths[0], low_memory=LOW_MEMORY)
+        # ru_maxrss is a lifetime peak, so it is only meaningful for a process
+        # that handled exactly one document.
+        if LOW_MEMORY:
+            peak_rss = peak_rss_mb()
+            if peak_rss is not None:
+                print(f"Peak memory (RSS): {peak_rss:.0f} MB")
+    else:
+        process_batch(pdf_paths)
\ No newline at end of file